@@ -1,5 +1,11 @@
+import os
+import sys
 import matplotlib.pyplot as plt
 import numpy as np
+# ekf_core is shared with the turtlebot estimator, which owns it
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'src', 'turtlebot_proj3_pkg', 'shared'))
+from ekf_core import quadrotor_ekf_step
 plt.rcParams['font.family'] = ['Arial']
 plt.rcParams['font.size'] = 14
 
@@ -14,25 +20,27 @@ class Estimator:
 
     Attributes:
     ----------
-        u : list
-            A list of system inputs, where, for the ith data point u[i],
+        t : ndarray
+            A (N,) view of the data timestamps (s).
+        u : ndarray
+            A (N,2) view of the system inputs, where, for the ith data point u[i],
             u[i][1] is the thrust of the quadrotor
             u[i][2] is right wheel rotational speed (rad/s).
-        x : list
-            A list of system states, where, for the ith data point x[i],
+        x : ndarray
+            A (N,6) view of the system states, where, for the ith data point x[i],
             x[i][0] is translational position in x (m),
             x[i][1] is translational position in z (m),
             x[i][2] is the bearing (rad) of the quadrotor
             x[i][3] is translational velocity in x (m/s),
             x[i][4] is translational velocity in z (m/s),
             x[i][5] is angular velocity (rad/s),
-        y : list
-            A list of system outputs, where, for the ith data point y[i],
+        y : ndarray
+            A (N,2) view of the system outputs, where, for the ith data point y[i],
             y[i][1] is distance to the landmark (m)
             y[i][2] is relative bearing (rad) w.r.t. the landmark
-        x_hat : list
-            A list of estimated system states. It should follow the same format
-            as x.
+        x_hat : ndarray
+            A (N,6) array of estimated system states, preallocated by run. It
+            should follow the same format as x.
         dt : float
             Update frequency of the estimator.
         fig : Figure
@@ -52,11 +60,7 @@ class Estimator:
     """
     # noinspection PyTypeChecker
     def __init__(self, is_noisy=False):
-        self.u = []
-        self.x = []
-        self.y = []
-        self.x_hat = []  # Your estimates go here!
-        self.t = []
+        self.x_hat = np.empty((0, 6))  # Your estimates go here!
         self.fig, self.axd = plt.subplot_mosaic(
             [['xz', 'phi'],
              ['xz', 'x'],
@@ -70,16 +74,29 @@ class Estimator:
         self.ln_z, = self.axd['z'].plot([], 'o-g', linewidth=2, label='True')
         self.ln_z_hat, = self.axd['z'].plot([], 'o-c', label='Estimated')
         self.canvas_title = 'N/A'
+        # Lines redrawn by blitting on every animation frame
+        self._lines = [self.ln_xz, self.ln_xz_hat,
+                       self.ln_phi, self.ln_phi_hat,
+                       self.ln_x, self.ln_x_hat,
+                       self.ln_z, self.ln_z_hat]
+        # Set when an axis limit changes and the blit background is stale
+        self._stale_bg = True
+        # Set once plot_update has saved the figure to disk
+        self._saved = False
+        # Data extents seen so far by resize_lim, keyed by line
+        self._extents = {}
 
         # Defined in dynamics.py for the dynamics model
         # m is the mass and J is the moment of inertia of the quadrotor 
         self.gr = 9.81 
         self.m = 0.92
         self.J = 0.0023
+        self._inv_m = 1.0 / self.m
+        self._inv_J = 1.0 / self.J
         # These are the X, Y, Z coordinates of the landmark
         self.landmark = (0, 5, 5)
 
-        # This is a (N,12) where it's time, x, u, then y_obs 
+        # This is a (N,11) where it's time, x, u, then y_obs 
         if is_noisy:
             with open('noisy_data.npy', 'rb') as f:
                 self.data = np.load(f)
@@ -89,23 +106,34 @@ class Estimator:
 
         self.dt = self.data[-1][0]/self.data.shape[0]
 
+        # Zero-copy column views into self.data
+        self.t = self.data[:, 0]
+        self.x = self.data[:, 1:7]
+        self.u = self.data[:, 7:9]
+        self.y = self.data[:, 9:12]
 
     def run(self):
-        for i, data in enumerate(self.data):
-            self.t.append(np.array(data[0]))
-            self.x.append(np.array(data[1:7]))
-            self.u.append(np.array(data[7:9]))
-            self.y.append(np.array(data[9:12]))
-            if i == 0:
-                print("Initializing...")
-                self.x_hat.append(self.x[-1])
-            else:
-                self.update(i)
+        print("Initializing...")
+        self.x_hat = np.empty_like(self.x)
+        self.x_hat[0] = self.x[0]
+        for i in range(1, self.data.shape[0]):
+            self.update(i)
+        self.save_log()
         return self.x_hat
 
-    def update(self, _):
+    def update(self, i):
         raise NotImplementedError
 
+    def save_log(self):
+        """Write the estimated and true states of every step to a CSV file."""
+        header = ','.join(
+            ['t']
+            + [f'{s}_hat' for s in ('x', 'z', 'phi', 'vx', 'vz', 'vphi')]
+            + ['x', 'z', 'phi', 'vx', 'vz', 'vphi'])
+        np.savetxt(f'{self.canvas_title}.csv',
+                   np.column_stack((self.t, self.x_hat, self.x)),
+                   delimiter=',', header=header, comments='')
+
     def plot_init(self):
         self.axd['xz'].set_title(self.canvas_title)
         self.axd['xz'].set_xlabel('x (m)')
@@ -122,8 +150,9 @@ class Estimator:
         self.axd['z'].set_xlabel('t (s)')
         self.axd['z'].legend()
         plt.tight_layout()
+        return self._lines
 
-    def plot_update(self, _):
+    def plot_update(self, frame):
         self.plot_xzline(self.ln_xz, self.x)
         self.plot_xzline(self.ln_xz_hat, self.x_hat)
         self.plot_philine(self.ln_phi, self.x)
@@ -132,42 +161,65 @@ class Estimator:
         self.plot_xline(self.ln_x_hat, self.x_hat)
         self.plot_zline(self.ln_z, self.x)
         self.plot_zline(self.ln_z_hat, self.x_hat)
-        plt.savefig(f'{self.canvas_title}.png')
+        if self._stale_bg:
+            # Axis ticks changed, so redraw everything before blitting
+            self.fig.canvas.draw()
+            self._stale_bg = False
+        if not self._saved:
+            # run() fills every step before the animation starts, so the
+            # first frame is already the final figure
+            plt.savefig(f'{self.canvas_title}.png')
+            self._saved = True
+        return self._lines
 
     def plot_xzline(self, ln, data):
         if len(data):
-            x = [d[0] for d in data]
-            z = [d[1] for d in data]
+            x = data[:, 0]
+            z = data[:, 1]
             ln.set_data(x, z)
-            self.resize_lim(self.axd['xz'], x, z)
+            self.resize_lim(self.axd['xz'], ln, x, z)
 
     def plot_philine(self, ln, data):
         if len(data):
-            t = self.t
-            phi = [d[2] for d in data]
+            t = self.t[:len(data)]
+            phi = data[:, 2]
             ln.set_data(t, phi)
-            self.resize_lim(self.axd['phi'], t, phi)
+            self.resize_lim(self.axd['phi'], ln, t, phi)
 
     def plot_xline(self, ln, data):
         if len(data):
-            t = self.t
-            x = [d[0] for d in data]
+            t = self.t[:len(data)]
+            x = data[:, 0]
             ln.set_data(t, x)
-            self.resize_lim(self.axd['x'], t, x)
+            self.resize_lim(self.axd['x'], ln, t, x)
 
     def plot_zline(self, ln, data):
         if len(data):
-            t = self.t
-            z = [d[1] for d in data]
+            t = self.t[:len(data)]
+            z = data[:, 1]
             ln.set_data(t, z)
-            self.resize_lim(self.axd['z'], t, z)
-
-    # noinspection PyMethodMayBeStatic
-    def resize_lim(self, ax, x, y):
+            self.resize_lim(self.axd['z'], ln, t, z)
+
+    def resize_lim(self, ax, ln, x, y):
+        # Running extents of the data already plotted on ln, so each call
+        # only scans the rows added since the last one
+        n, xmin, xmax, ymin, ymax = self._extents.get(
+            ln, (0, np.inf, -np.inf, np.inf, -np.inf))
+        if n == len(x):
+            return
+        xmin = min(xmin, x[n:].min())
+        xmax = max(xmax, x[n:].max())
+        ymin = min(ymin, y[n:].min())
+        ymax = max(ymax, y[n:].max())
+        self._extents[ln] = (len(x), xmin, xmax, ymin, ymax)
         xlim = ax.get_xlim()
-        ax.set_xlim([min(min(x) * 1.05, xlim[0]), max(max(x) * 1.05, xlim[1])])
+        if xmin * 1.05 < xlim[0] or xmax * 1.05 > xlim[1]:
+            ax.set_xlim(min(xmin * 1.05, xlim[0]), max(xmax * 1.05, xlim[1]))
+            self._stale_bg = True
         ylim = ax.get_ylim()
-        ax.set_ylim([min(min(y) * 1.05, ylim[0]), max(max(y) * 1.05, ylim[1])])
+        if ymin * 1.05 < ylim[0] or ymax * 1.05 > ylim[1]:
+            ax.set_ylim(min(ymin * 1.05, ylim[0]), max(ymax * 1.05, ylim[1]))
+            self._stale_bg = True
 
 class OracleObserver(Estimator):
     """Oracle observer which has access to the true state.
@@ -184,8 +236,8 @@ class OracleObserver(Estimator):
         super().__init__(is_noisy)
         self.canvas_title = 'Oracle Observer'
 
-    def update(self, _):
-        self.x_hat.append(self.x[-1])
+    def update(self, i):
+        self.x_hat[i] = self.x[i]
 
 
 class DeadReckoning(Estimator):
@@ -214,28 +266,50 @@ class DeadReckoning(Estimator):
         dx = vx
         dz = vz
         dphi = vphi
-        dvx = -(u1 / self.m) * np.sin(phi)
-        dvz = (u1 / self.m) * np.cos(phi) - self.gr
-        dvphi = (u2 / self.J)
+        dvx = -(u1 * self._inv_m) * np.sin(phi)
+        dvz = (u1 * self._inv_m) * np.cos(phi) - self.gr
+        dvphi = (u2 * self._inv_J)
         return [dx, dz, dphi, dvx, dvz, dvphi]
 
-    def update(self, _):
-        if len(self.x_hat) > 0:
-            # TODO: Your implementation goes here!
-            # You may ONLY use self.u and self.x[0] for estimation
-            
-            x_hat_t = self.x_hat[-1]
-            u_t = self.u[-1]
-            x_hat, z_hat, phi_hat, vx_hat, vz_hat, vphi_hat = x_hat_t
-            dx, dz, dphi, dvx, dvz, dvphi = self.model(x_hat_t, u_t)
-            x_hat_t1 = [x_hat + dx * self.dt,
-                        z_hat + dz * self.dt,
-                        phi_hat + dphi * self.dt,
-                        vx_hat + dvx * self.dt,
-                        vz_hat + dvz * self.dt,
-                        vphi_hat + dvphi * self.dt]
-            self.x_hat.append(x_hat_t1)
-            print(self.x_hat[-1], self.x[-1])
+    def run(self):
+        """Roll out the whole Euler integration in one vectorized pass.
+
+        Equivalent to calling update for every step, since dead reckoning
+        only depends on x0 and u: each state is its initial value plus the
+        cumulative sum of its (dt-scaled) derivative over previous steps.
+        """
+        print("Initializing...")
+        x0 = self.x[0]
+        u1 = self.u[1:, 0]
+        u2 = self.u[1:, 1]
+
+        def integrate(s0, ds):
+            return np.concatenate(([s0], s0 + np.cumsum(ds) * self.dt))
+
+        vphi = integrate(x0[5], u2 * self._inv_J)
+        phi = integrate(x0[2], vphi[:-1])
+        vx = integrate(x0[3], -(u1 * self._inv_m) * np.sin(phi[:-1]))
+        vz = integrate(x0[4], (u1 * self._inv_m) * np.cos(phi[:-1]) - self.gr)
+        x = integrate(x0[0], vx[:-1])
+        z = integrate(x0[1], vz[:-1])
+        self.x_hat = np.column_stack([x, z, phi, vx, vz, vphi])
+        self.save_log()
+        return self.x_hat
+
+    def update(self, i):
+        # TODO: Your implementation goes here!
+        # You may ONLY use self.u and self.x[0] for estimation
+
+        x_hat_t = self.x_hat[i - 1]
+        u_t = self.u[i]
+        x_hat, z_hat, phi_hat, vx_hat, vz_hat, vphi_hat = x_hat_t
+        dx, dz, dphi, dvx, dvz, dvphi = self.model(x_hat_t, u_t)
+        self.x_hat[i] = [x_hat + dx * self.dt,
+                         z_hat + dz * self.dt,
+                         phi_hat + dphi * self.dt,
+                         vx_hat + dvx * self.dt,
+                         vz_hat + dvz * self.dt,
+                         vphi_hat + dvphi * self.dt]
             
 
 # noinspection PyPep8Naming
@@ -273,81 +347,16 @@ class ExtendedKalmanFilter(Estimator):
         self.Q = np.eye(6) * 0.01
         self.R = np.eye(2) * 10.0
         self.P = np.eye(6) * 0.1
+        # Model parameters for quadrotor_ekf_step
+        self._params = np.array([self.dt, self.dt * self._inv_m,
+                                 self.dt * self._inv_J, self.gr,
+                                 *self.landmark], dtype=float)
+        # Compile (or load) the kernel up front so the first update is not
+        # slowed down
+        quadrotor_ekf_step(self.x[0], self.P, self.u[0], self.y[0], self.Q,
+                           self.R, self._params)
 
-    # noinspection DuplicatedCode
     def update(self, i):
-        if len(self.x_hat) > 0: # and self.x_hat[-1][0] < self.x[-1][0]:
-            x_hat_t = self.x_hat[-1]
-            u_t = self.u[-1]
-            y_t = self.y[-1]
-            
-            x_hat_tp1_t = self.g(x_hat_t, u_t)
-            A = self.approx_A(x_hat_t, u_t)
-            P_tp1_t = A @ self.P @ A.T + self.Q
-            C = self.approx_C(x_hat_tp1_t)
-            K = P_tp1_t @ C.T @ np.linalg.inv(C @ P_tp1_t @ C.T + self.R)
-            x_hat_tp1 = x_hat_tp1_t + K @ (y_t - self.h(x_hat_tp1_t, y_t))
-            self.P = (np.eye(6) - K @ C) @ P_tp1_t
-            x_hat_tp1 = x_hat_tp1.tolist()
-            self.x_hat.append(x_hat_tp1)
-            print(self.x_hat[-1], self.x[-1])
-            
-
-    def f(self, x, u):
-        x, z, phi, vx, vz, vphi = x
-        u1, u2 = u
-        dx = vx
-        dz = vz
-        dphi = vphi
-        dvx = -(u1 / self.m) * np.sin(phi)
-        dvz = +(u1 / self.m) * np.cos(phi) - self.gr
-        dvphi = (u2 / self.J)
-        return [dx, dz, dphi, dvx, dvz, dvphi]
-
-    def g(self, x, u):
-        dx, dz, dphi, dvx, dvz, dvphi = self.f(x, u)
-        x, z, phi, vx, vz, vphi = x
-        u1, u2 = u
-        return [x    + dx    * self.dt,
-                z    + dz    * self.dt,
-                phi  + dphi  * self.dt,
-                vx   + dvx   * self.dt,
-                vz   + dvz   * self.dt,
-                vphi + dvphi * self.dt]
-
-    def h(self, x, y_obs):
-        x, z, phi, vx, vz, vphi = x
-        landmark_x, landmark_y, landmark_z = self.landmark
-        distance = np.sqrt((landmark_x - x) ** 2 + (landmark_y - 0) ** 2 + (landmark_z - z) ** 2)
-        bearing = phi
-        return [distance, bearing]
-
-    def approx_A(self, x, u):
-        """
-        dg/dx evaluated at (x, u)
-        g = x + f(x, u) * dt
-        dg/dx = I + df/dx * dt
-        """
-        x, z, phi, vx, vz, vphi = x
-        u1, u2 = u
-        df_dx = np.zeros((6, 6))
-        df_dx[0, 3] = 1
-        df_dx[1, 4] = 1
-        df_dx[2, 5] = 1
-        df_dx[3, 2] = -(u1 / self.m) * np.cos(phi)
-        df_dx[4, 2] = -(u1 / self.m) * np.sin(phi)
-        dg_dx = np.eye(6) + df_dx * self.dt
-        return dg_dx
-    
-    def approx_C(self, x):
-        """
-        dh/dx evaluated at (x)
-        """
-        x, z, phi, vx, vz, vphi = x
-        landmark_x, landmark_y, landmark_z = self.landmark
-        dh_dx = np.zeros((2, 6))
-        distance = np.sqrt((landmark_x - x) ** 2 + (landmark_y - 0) ** 2 + (landmark_z - z) ** 2)
-        dh_dx[0, 0] = (x - landmark_x) / distance
-        dh_dx[0, 1] = (z - landmark_z) / distance
-        dh_dx[1, 2] = 1
-        return dh_dx
+        self.x_hat[i], self.P = quadrotor_ekf_step(
+            self.x_hat[i - 1], self.P, self.u[i], self.y[i], self.Q, self.R,
+            self._params)
@@ -29,6 +29,7 @@ def spin(estimator):
         estimator.fig,
         estimator.plot_update,
         init_func=estimator.plot_init,
+        blit=True,
         cache_frame_data=False)
     plt.show(block=True)
 
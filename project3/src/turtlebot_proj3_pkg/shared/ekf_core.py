@@ -0,0 +1,148 @@
+import numpy as np
+from numba import njit
+
+
+# noinspection PyPep8Naming
+@njit(cache=True, fastmath=True)
+def quadrotor_ekf_step(x, P, u, y, Q, R, params):
+    """One extended Kalman filter step for the planar quadrotor.
+
+    Returns the posterior state estimate and covariance.
+    """
+    x_tp1_t, A = quadrotor_predict(x, u, params)
+    P_tp1_t = A @ P @ A.T + Q
+    h, CP, S = quadrotor_measure(x_tp1_t, P_tp1_t, R, params)
+    return correct(x_tp1_t, P_tp1_t, y, h, CP, S)
+
+
+# noinspection PyPep8Naming
+@njit(cache=True, fastmath=True)
+def unicycle_ekf_step(x, P, u, y, Q, R, params):
+    """One extended Kalman filter step for the unicycle.
+
+    Returns the posterior state estimate and covariance.
+    """
+    x_tp1_t, A = unicycle_predict(x, u, params)
+    P_tp1_t = A @ P @ A.T + Q
+    h, CP, S = unicycle_measure(x_tp1_t, P_tp1_t, R, params)
+    return correct(x_tp1_t, P_tp1_t, y, h, CP, S)
+
+
+# noinspection PyPep8Naming
+@njit(cache=True, fastmath=True)
+def correct(x_tp1_t, P_tp1_t, y, h, CP, S):
+    """
+    Measurement update shared by every model, given the prediction, h(x),
+    C P and S = C P C^T + R for a 2-dimensional measurement.
+    """
+    K = gain(CP, S)
+    return x_tp1_t + K @ (y - h), P_tp1_t - K @ CP
+
+
+# noinspection PyPep8Naming
+@njit(cache=True, fastmath=True)
+def gain(CP, S):
+    """
+    K = P C^T S^-1 = (C P)^T S^-1, with the 2x2 inverse of S expanded in
+    closed form. P is symmetric, so C P doubles as (P C^T)^T.
+    """
+    d = 1.0 / (S[0, 0] * S[1, 1] - S[0, 1] * S[1, 0])
+    K = np.empty((CP.shape[1], 2))
+    K[:, 0] = (CP[0] * S[1, 1] - CP[1] * S[1, 0]) * d
+    K[:, 1] = (CP[1] * S[0, 0] - CP[0] * S[0, 1]) * d
+    return K
+
+
+@njit(cache=True, fastmath=True)
+def quadrotor_predict(x, u, params):
+    """
+    g(x, u) and dg/dx evaluated at (x, u) for the planar quadrotor
+    g = x + f(x, u) * dt
+    dg/dx = I + df/dx * dt
+    params is (dt, dt / m, dt / J, gr, landmark_x, landmark_y, landmark_z).
+    """
+    dt, dt_over_m, dt_over_J, gr = params[0], params[1], params[2], params[3]
+    phi = x[2]
+    u1 = u[0]
+    u2 = u[1]
+    s = np.sin(phi)
+    c = np.cos(phi)
+    a = u1 * dt_over_m
+    g = np.array([x[0] + x[3] * dt,
+                  x[1] + x[4] * dt,
+                  phi  + x[5] * dt,
+                  x[3] - a * s,
+                  x[4] + a * c - gr * dt,
+                  x[5] + u2 * dt_over_J])
+    dg_dx = np.eye(6)
+    dg_dx[0, 3] = dt
+    dg_dx[1, 4] = dt
+    dg_dx[2, 5] = dt
+    dg_dx[3, 2] = -a * c
+    dg_dx[4, 2] = -a * s
+    return g, dg_dx
+
+
+# noinspection PyPep8Naming
+@njit(cache=True, fastmath=True)
+def quadrotor_measure(x, P, R, params):
+    """
+    h(x) = [distance to the landmark, bearing], and C P, C P C^T + R for
+    dh/dx = [[c00, c01, 0, 0, 0, 0],
+             [0,   0,   1, 0, 0, 0]]
+    expanded over the three nonzero entries of C.
+    """
+    lx, ly, lz = params[4], params[5], params[6]
+    dx = lx - x[0]
+    dz = lz - x[1]
+    distance = np.sqrt(dx * dx + ly * ly + dz * dz)
+    h = np.array([distance, x[2]])
+    c00 = -dx / distance
+    c01 = -dz / distance
+    CP = np.empty((2, 6))
+    CP[0] = c00 * P[0] + c01 * P[1]
+    CP[1] = P[2]
+    S = np.empty((2, 2))
+    S[0, 0] = c00 * CP[0, 0] + c01 * CP[0, 1] + R[0, 0]
+    S[0, 1] = CP[0, 2] + R[0, 1]
+    S[1, 0] = c00 * CP[1, 0] + c01 * CP[1, 1] + R[1, 0]
+    S[1, 1] = CP[1, 2] + R[1, 1]
+    return h, CP, S
+
+
+@njit(cache=True, fastmath=True)
+def unicycle_predict(x, u, params):
+    """
+    g(x, u) and dg/dx evaluated at (x, u) for the unicycle
+    g = x + f(x, u) * dt
+    dg/dx = I + df/dx * dt
+    params is (dt, dt * r / 2, dt * r / (2 * d)).
+    """
+    dt, dt_r_half, dt_r_over_2d = params[0], params[1], params[2]
+    phi = x[0]
+    u1 = u[0]
+    u2 = u[1]
+    s = np.sin(phi)
+    c = np.cos(phi)
+    v = (u1 + u2) * dt_r_half
+    g = np.array([phi  + (u2 - u1) * dt_r_over_2d,
+                  x[1] + v * c,
+                  x[2] + v * s,
+                  x[3] + u1 * dt,
+                  x[4] + u2 * dt])
+    dg_dx = np.eye(5)
+    dg_dx[1, 0] = -v * s
+    dg_dx[2, 0] = +v * c
+    return g, dg_dx
+
+
+# noinspection PyPep8Naming
+@njit(cache=True, fastmath=True)
+def unicycle_measure(x, P, R, params):
+    """
+    h(x) = Cx, and C P, C P C^T + R, where C selects x and y
+    """
+    h = x[1:3].copy()
+    CP = np.ascontiguousarray(P[1:3])
+    S = CP[:, 1:3] + R
+    return h, CP, S
@@ -1,9 +1,13 @@
+import os
+import sys
 import rospy
 from std_msgs.msg import Float32MultiArray
-import matplotlib.pyplot as plt
 import numpy as np
-plt.rcParams['font.family'] = ['FreeSans', 'Helvetica', 'Arial']
-plt.rcParams['font.size'] = 14
+import pyqtgraph as pg
+# ekf_core is shared with the drone estimator, see ../shared
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'shared'))
+from ekf_core import correct, unicycle_ekf_step
 
 
 class Estimator:
@@ -20,40 +24,45 @@ class Estimator:
             Half of the track width (m) of TurtleBot3 Burger.
         r : float
             Wheel radius (m) of the TurtleBot3 Burger.
-        u : list
-            A list of system inputs, where, for the ith data point u[i],
+        u : ndarray
+            A buffer of system inputs filled up to _n_u, where, for the ith
+            data point u[i],
             u[i][0] is timestamp (s),
             u[i][1] is left wheel rotational speed (rad/s), and
             u[i][2] is right wheel rotational speed (rad/s).
-        x : list
-            A list of system states, where, for the ith data point x[i],
+        x : ndarray
+            A buffer of system states filled up to _n_x, where, for the ith
+            data point x[i],
             x[i][0] is timestamp (s),
             x[i][1] is bearing (rad),
             x[i][2] is translational position in x (m),
             x[i][3] is translational position in y (m),
             x[i][4] is left wheel rotational position (rad), and
             x[i][5] is right wheel rotational position (rad).
-        y : list
-            A list of system outputs, where, for the ith data point y[i],
+        y : ndarray
+            A buffer of system outputs filled up to _n_y, where, for the ith
+            data point y[i],
             y[i][0] is timestamp (s),
             y[i][1] is translational position in x (m) when freeze_bearing:=true,
             y[i][1] is distance to the landmark (m) when freeze_bearing:=false,
             y[i][2] is translational position in y (m) when freeze_bearing:=true, and
             y[i][2] is relative bearing (rad) w.r.t. the landmark when
             freeze_bearing:=false.
-        x_hat : list
-            A list of estimated system states. It should follow the same format
-            as x.
+        x_hat : ndarray
+            A buffer of estimated system states filled up to _n_x_hat. It
+            should follow the same format as x.
         dt : float
             Update frequency of the estimator.
-        fig : Figure
-            matplotlib Figure for real-time plotting.
+        app : QApplication
+            Qt application running the plotting event loop.
+        win : GraphicsLayoutWidget
+            pyqtgraph window for real-time plotting.
         axd : dict
-            A dictionary of matplotlib Axis for real-time plotting.
-        ln* : Line
-            matplotlib Line object for ground truth states.
-        ln_*_hat : Line
-            matplotlib Line object for estimated states.
+            A dictionary of pyqtgraph PlotItem for real-time plotting.
+        ln* : PlotDataItem
+            pyqtgraph curve for ground truth states.
+        ln_*_hat : PlotDataItem
+            pyqtgraph curve for estimated states.
         canvas_title : str
             Title of the real-time plot, which is chosen to be estimator type.
         sub_u : rospy.Subscriber
@@ -73,29 +82,43 @@ class Estimator:
     def __init__(self):
         self.d = 0.08
         self.r = 0.033
-        self.u = []
-        self.x = []
-        self.y = []
-        self.x_hat = []  # Your estimates go here!
+        self._r_half = self.r / 2
+        self._r_over_2d = self.r / (2 * self.d)
+        # Preallocated buffers which double in size when full, and the
+        # number of rows filled in each
+        self.u = np.empty((1024, 3))
+        self.x = np.empty((1024, 6))
+        self.y = np.empty((1024, 3))
+        self.x_hat = np.empty((1024, 6))  # Your estimates go here!
+        self._n_u = 0
+        self._n_x = 0
+        self._n_y = 0
+        self._n_x_hat = 0
         self.dt = 0.1
-        self.fig, self.axd = plt.subplot_mosaic(
-            [['xy', 'phi'],
-             ['xy', 'x'],
-             ['xy', 'y'],
-             ['xy', 'thl'],
-             ['xy', 'thr']], figsize=(20.0, 10.0))
-        self.ln_xy, = self.axd['xy'].plot([], 'o-g', linewidth=2, label='True')
-        self.ln_xy_hat, = self.axd['xy'].plot([], 'o-c', label='Estimated')
-        self.ln_phi, = self.axd['phi'].plot([], 'o-g', linewidth=2, label='True')
-        self.ln_phi_hat, = self.axd['phi'].plot([], 'o-c', label='Estimated')
-        self.ln_x, = self.axd['x'].plot([], 'o-g', linewidth=2, label='True')
-        self.ln_x_hat, = self.axd['x'].plot([], 'o-c', label='Estimated')
-        self.ln_y, = self.axd['y'].plot([], 'o-g', linewidth=2, label='True')
-        self.ln_y_hat, = self.axd['y'].plot([], 'o-c', label='Estimated')
-        self.ln_thl, = self.axd['thl'].plot([], 'o-g', linewidth=2, label='True')
-        self.ln_thl_hat, = self.axd['thl'].plot([], 'o-c', label='Estimated')
-        self.ln_thr, = self.axd['thr'].plot([], 'o-g', linewidth=2, label='True')
-        self.ln_thr_hat, = self.axd['thr'].plot([], 'o-c', label='Estimated')
+        self.app = pg.mkQApp('Estimator')
+        self.win = pg.GraphicsLayoutWidget(size=(2000, 1000))
+        self.axd = {'xy': self.win.addPlot(row=0, col=0, rowspan=5)}
+        for row, key in enumerate(['phi', 'x', 'y', 'thl', 'thr']):
+            self.axd[key] = self.win.addPlot(row=row, col=1)
+        for ax in self.axd.values():
+            ax.addLegend()
+        # 'o-' lines, as in the matplotlib version
+        true = dict(pen=pg.mkPen('g', width=2), symbol='o', symbolSize=6,
+                    symbolPen='g', symbolBrush='g', name='True')
+        est = dict(pen='c', symbol='o', symbolSize=6,
+                   symbolPen='c', symbolBrush='c', name='Estimated')
+        self.ln_xy = self.axd['xy'].plot(**true)
+        self.ln_xy_hat = self.axd['xy'].plot(**est)
+        self.ln_phi = self.axd['phi'].plot(**true)
+        self.ln_phi_hat = self.axd['phi'].plot(**est)
+        self.ln_x = self.axd['x'].plot(**true)
+        self.ln_x_hat = self.axd['x'].plot(**est)
+        self.ln_y = self.axd['y'].plot(**true)
+        self.ln_y_hat = self.axd['y'].plot(**est)
+        self.ln_thl = self.axd['thl'].plot(**true)
+        self.ln_thl_hat = self.axd['thl'].plot(**est)
+        self.ln_thr = self.axd['thr'].plot(**true)
+        self.ln_thr_hat = self.axd['thr'].plot(**est)
         self.canvas_title = 'N/A'
         self.sub_u = rospy.Subscriber('u', Float32MultiArray, self.callback_u)
         self.sub_x = rospy.Subscriber('x', Float32MultiArray, self.callback_x)
@@ -103,101 +126,101 @@ class Estimator:
         self.tmr_update = rospy.Timer(rospy.Duration(self.dt), self.update)
 
     def callback_u(self, msg):
-        self.u.append(msg.data)
+        self.u = self.grow(self.u, self._n_u)
+        self.u[self._n_u] = msg.data
+        self._n_u += 1
 
     def callback_x(self, msg):
-        self.x.append(msg.data)
-        if len(self.x_hat) == 0:
-            self.x_hat.append(msg.data)
+        self.x = self.grow(self.x, self._n_x)
+        self.x[self._n_x] = msg.data
+        self._n_x += 1
+        if self._n_x_hat == 0:
+            self.append_x_hat(msg.data)
 
     def callback_y(self, msg):
-        self.y.append(msg.data)
+        self.y = self.grow(self.y, self._n_y)
+        self.y[self._n_y] = msg.data
+        self._n_y += 1
+
+    def append_x_hat(self, x_hat):
+        self.x_hat = self.grow(self.x_hat, self._n_x_hat)
+        self.x_hat[self._n_x_hat] = x_hat
+        self._n_x_hat += 1
+
+    @staticmethod
+    def grow(buf, n):
+        """Return buf, or a copy with double the rows if its n rows are full.
+
+        Writers assign the grown buffer and fill the row before incrementing
+        its counter, and the first n rows are the same in the old and new
+        buffer, so a reader that loads a counter before its buffer attribute
+        only sees filled rows. A counter of 0 means the buffer holds no rows
+        at all; index [n - 1] only after checking n > 0.
+        """
+        if n == len(buf):
+            buf = np.resize(buf, (2 * len(buf), buf.shape[1]))
+        return buf
 
     def update(self, _):
         raise NotImplementedError
 
     def plot_init(self):
-        self.axd['xy'].set_title(self.canvas_title)
-        self.axd['xy'].set_xlabel('x (m)')
-        self.axd['xy'].set_ylabel('y (m)')
-        self.axd['xy'].set_aspect('equal', adjustable='box')
-        self.axd['xy'].legend()
-        self.axd['phi'].set_ylabel('phi (rad)')
-        self.axd['phi'].legend()
-        self.axd['x'].set_ylabel('x (m)')
-        self.axd['x'].legend()
-        self.axd['y'].set_ylabel('y (m)')
-        self.axd['y'].legend()
-        self.axd['thl'].set_ylabel('theta L (rad)')
-        self.axd['thl'].legend()
-        self.axd['thr'].set_ylabel('theta R (rad)')
-        self.axd['thr'].set_xlabel('Time (s)')
-        self.axd['thr'].legend()
-        plt.tight_layout()
-
-    def plot_update(self, _):
-        self.plot_xyline(self.ln_xy, self.x)
-        self.plot_xyline(self.ln_xy_hat, self.x_hat)
-        self.plot_philine(self.ln_phi, self.x)
-        self.plot_philine(self.ln_phi_hat, self.x_hat)
-        self.plot_xline(self.ln_x, self.x)
-        self.plot_xline(self.ln_x_hat, self.x_hat)
-        self.plot_yline(self.ln_y, self.x)
-        self.plot_yline(self.ln_y_hat, self.x_hat)
-        self.plot_thlline(self.ln_thl, self.x)
-        self.plot_thlline(self.ln_thl_hat, self.x_hat)
-        self.plot_thrline(self.ln_thr, self.x)
-        self.plot_thrline(self.ln_thr_hat, self.x_hat)
-        plt.savefig(f'{self.canvas_title}.png')
+        self.win.setWindowTitle(self.canvas_title)
+        self.axd['xy'].setTitle(self.canvas_title)
+        self.axd['xy'].setLabel('bottom', 'x (m)')
+        self.axd['xy'].setLabel('left', 'y (m)')
+        self.axd['xy'].setAspectLocked(True)
+        self.axd['phi'].setLabel('left', 'phi (rad)')
+        self.axd['x'].setLabel('left', 'x (m)')
+        self.axd['y'].setLabel('left', 'y (m)')
+        self.axd['thl'].setLabel('left', 'theta L (rad)')
+        self.axd['thr'].setLabel('left', 'theta R (rad)')
+        self.axd['thr'].setLabel('bottom', 'Time (s)')
+        self.win.show()
+
+    def plot_update(self):
+        n_x, n_x_hat = self._n_x, self._n_x_hat
+        x = self.x[:n_x]
+        x_hat = self.x_hat[:n_x_hat]
+        self.plot_xyline(self.ln_xy, x)
+        self.plot_xyline(self.ln_xy_hat, x_hat)
+        self.plot_philine(self.ln_phi, x)
+        self.plot_philine(self.ln_phi_hat, x_hat)
+        self.plot_xline(self.ln_x, x)
+        self.plot_xline(self.ln_x_hat, x_hat)
+        self.plot_yline(self.ln_y, x)
+        self.plot_yline(self.ln_y_hat, x_hat)
+        self.plot_thlline(self.ln_thl, x)
+        self.plot_thlline(self.ln_thl_hat, x_hat)
+        self.plot_thrline(self.ln_thr, x)
+        self.plot_thrline(self.ln_thr_hat, x_hat)
+
+    def plot_save(self):
+        self.win.grab().save(f'{self.canvas_title}.png')
 
     def plot_xyline(self, ln, data):
         if len(data):
-            x = [d[2] for d in data]
-            y = [d[3] for d in data]
-            ln.set_data(x, y)
-            self.resize_lim(self.axd['xy'], x, y)
+            ln.setData(data[:, 2], data[:, 3])
 
     def plot_philine(self, ln, data):
         if len(data):
-            t = [d[0] for d in data]
-            phi = [d[1] for d in data]
-            ln.set_data(t, phi)
-            self.resize_lim(self.axd['phi'], t, phi)
+            ln.setData(data[:, 0], data[:, 1])
 
     def plot_xline(self, ln, data):
         if len(data):
-            t = [d[0] for d in data]
-            x = [d[2] for d in data]
-            ln.set_data(t, x)
-            self.resize_lim(self.axd['x'], t, x)
+            ln.setData(data[:, 0], data[:, 2])
 
     def plot_yline(self, ln, data):
         if len(data):
-            t = [d[0] for d in data]
-            y = [d[3] for d in data]
-            ln.set_data(t, y)
-            self.resize_lim(self.axd['y'], t, y)
+            ln.setData(data[:, 0], data[:, 3])
 
     def plot_thlline(self, ln, data):
         if len(data):
-            t = [d[0] for d in data]
-            thl = [d[4] for d in data]
-            ln.set_data(t, thl)
-            self.resize_lim(self.axd['thl'], t, thl)
+            ln.setData(data[:, 0], data[:, 4])
 
     def plot_thrline(self, ln, data):
         if len(data):
-            t = [d[0] for d in data]
-            thr = [d[5] for d in data]
-            ln.set_data(t, thr)
-            self.resize_lim(self.axd['thr'], t, thr)
-
-    # noinspection PyMethodMayBeStatic
-    def resize_lim(self, ax, x, y):
-        xlim = ax.get_xlim()
-        ax.set_xlim([min(min(x) * 1.05, xlim[0]), max(max(x) * 1.05, xlim[1])])
-        ylim = ax.get_ylim()
-        ax.set_ylim([min(min(y) * 1.05, ylim[0]), max(max(y) * 1.05, ylim[1])])
+            ln.setData(data[:, 0], data[:, 5])
 
 
 class OracleObserver(Estimator):
@@ -219,7 +242,9 @@ class OracleObserver(Estimator):
         self.canvas_title = 'Oracle Observer'
 
     def update(self, _):
-        self.x_hat.append(self.x[-1])
+        n_x = self._n_x
+        if n_x > 0:
+            self.append_x_hat(self.x[n_x - 1])
 
 
 class DeadReckoning(Estimator):
@@ -250,17 +275,21 @@ class DeadReckoning(Estimator):
     def model(self, x, u):
         _, phi, x, y, thl, thr = x
         _, u_L, u_R = u
-        dphi = (u_R - u_L) * self.r / (2 * self.d)
-        dx = (u_R + u_L) * (self.r / 2) * np.cos(phi)
-        dy = (u_R + u_L) * (self.r / 2) * np.sin(phi)
+        dphi = (u_R - u_L) * self._r_over_2d
+        dx = (u_R + u_L) * self._r_half * np.cos(phi)
+        dy = (u_R + u_L) * self._r_half * np.sin(phi)
         dthl = u_L
         dthr = u_R
         return [dphi, dx, dy, dthl, dthr]
 
     def update(self, _):
-        if len(self.x_hat) > 0 and self.x_hat[-1][0] < self.x[-1][0]:
-            x_hat_t = self.x_hat[-1]
-            u_t = self.u[-1]
+        # Counters first, see grow. Wait for the first state and input; an
+        # empty buffer row is uninitialized
+        n_x_hat, n_x, n_u = self._n_x_hat, self._n_x, self._n_u
+        if (n_x_hat > 0 and n_x > 0 and n_u > 0 and
+                self.x_hat[n_x_hat - 1, 0] < self.x[n_x - 1, 0]):
+            x_hat_t = self.x_hat[n_x_hat - 1]
+            u_t = self.u[n_u - 1]
             dphi, dx, dy, dthl, dthr = self.model(x_hat_t, u_t)
             x_tp1 = [x_hat_t[0] + self.dt,
                      x_hat_t[1] + dphi * self.dt,
@@ -268,8 +297,8 @@ class DeadReckoning(Estimator):
                      x_hat_t[3] + dy * self.dt,
                      x_hat_t[4] + dthl * self.dt,
                      x_hat_t[5] + dthr * self.dt]
-            self.x_hat.append(x_tp1)
-            print(self.x_hat[-1], self.x[-1])
+            self.append_x_hat(x_tp1)
+            rospy.logdebug('x_hat: %s, x: %s', x_tp1, self.x[n_x - 1])
 
 
 class KalmanFilter(Estimator):
@@ -308,23 +337,35 @@ class KalmanFilter(Estimator):
         self.Q = np.eye(4) * 100.0
         self.R = np.eye(2)
         self.P = np.eye(4)
+        # Compile (or load) the kernel up front so the first update is not
+        # slowed down
+        correct(np.zeros(4), self.P, np.zeros(2), np.zeros(2), self.P[:2],
+                self.R)
 
     # noinspection DuplicatedCode
     # noinspection PyPep8Naming
     def update(self, _):
-        if len(self.x_hat) > 0 and self.x_hat[-1][0] < self.x[-1][0]:
-            x_t = self.x_hat[-1]
-            u_t = self.u[-1]
-            y_t = self.y[-1]
+        # Counters first, see grow. Wait for the first state, input and
+        # output; an empty buffer row is uninitialized
+        n_x_hat, n_x = self._n_x_hat, self._n_x
+        n_u, n_y = self._n_u, self._n_y
+        if (n_x_hat > 0 and n_x > 0 and n_u > 0 and n_y > 0 and
+                self.x_hat[n_x_hat - 1, 0] < self.x[n_x - 1, 0]):
+            x_t = self.x_hat[n_x_hat - 1]
+            u_t = self.u[n_u - 1]
+            y_t = self.y[n_y - 1]
             
             x_hat_tp1_t = np.dot(self.A, x_t[2:]) + np.dot(self.B, u_t[1:])
             P_tp1_t = self.A @ self.P @ self.A.T + self.Q
-            K = P_tp1_t @ self.C.T @ np.linalg.inv(self.C @ P_tp1_t @ self.C.T + self.R)
-            x_hat_tp1 = x_hat_tp1_t + K @ (np.array(y_t[1:]) - self.C @ x_hat_tp1_t)
-            self.P = (np.eye(4) - K @ self.C) @ P_tp1_t
-            x_hat_tp1 = [self.x_hat[-1][0] + self.dt, self.phid, x_hat_tp1[0], x_hat_tp1[1], x_hat_tp1[2], x_hat_tp1[3]]
-            self.x_hat.append(x_hat_tp1)
-            print(self.x_hat[-1], self.x[-1])
+            # C only selects the first two states, so h(x), C P and C P C^T
+            # are slices of x and P
+            CP = P_tp1_t[:2]
+            S = CP[:, :2] + self.R
+            x_hat_tp1, self.P = correct(x_hat_tp1_t, P_tp1_t, y_t[1:],
+                                        x_hat_tp1_t[:2], CP, S)
+            x_tp1 = np.concatenate(([x_t[0] + self.dt, self.phid], x_hat_tp1))
+            self.append_x_hat(x_tp1)
+            rospy.logdebug('x_hat: %s, x: %s', x_tp1, self.x[n_x - 1])
 
 # noinspection PyPep8Naming
 class ExtendedKalmanFilter(Estimator):
@@ -364,67 +405,29 @@ class ExtendedKalmanFilter(Estimator):
         self.Q = np.diag([0.01, 0.25, 0.25, 0.01, 0.01])
         self.R = np.eye(2) * 100.0
         self.P = np.diag([1.0, 0.25, 0.25, 100.0, 100.0])
+        # Model parameters for unicycle_ekf_step
+        self._params = np.array([self.dt, self.dt * self._r_half,
+                                 self.dt * self._r_over_2d])
+        # Compile (or load) the kernel up front so the first update is not
+        # slowed down
+        unicycle_ekf_step(np.zeros(5), self.P, np.zeros(2), np.zeros(2),
+                          self.Q, self.R, self._params)
 
-    # noinspection DuplicatedCode
     def update(self, _):
-        if len(self.x_hat) > 0 and self.x_hat[-1][0] < self.x[-1][0]:
-            x_hat_t = self.x_hat[-1][1:]
-            u_t = self.u[-1][1:]
-            y_t = self.y[-1][1:]
-            
-            x_hat_tp1_t = self.g(x_hat_t, u_t)
-            A = self.approx_A(x_hat_t, u_t)
-            P_tp1_t = A @ self.P @ A.T + self.Q
-            C = self.approx_C(x_hat_tp1_t)
-            K = P_tp1_t @ C.T @ np.linalg.inv(C @ P_tp1_t @ C.T + self.R)
-            x_hat_tp1 = x_hat_tp1_t + K @ (y_t - self.h(x_hat_tp1_t, y_t))
-            self.P = (np.eye(5) - K @ C) @ P_tp1_t
-            x_hat_tp1 = x_hat_tp1.tolist()
-            x_hat_tp1 = [self.x_hat[-1][0] + self.dt] + x_hat_tp1
-            self.x_hat.append(x_hat_tp1)
-            print(self.x_hat[-1], self.x[-1], self.y[-1])
-            
-    def f(self, x, u):
-        phi, x, y, thl, thr = x
-        u1, u2 = u
-        dphi = (u2 - u1) * self.r / (2 * self.d)
-        dx = (u2 + u1) * (self.r / 2) * np.cos(phi)
-        dy = (u2 + u1) * (self.r / 2) * np.sin(phi)
-        dthl = u1
-        dthr = u2
-        return [dphi, dx, dy, dthl, dthr]
-
-    def g(self, x, u):
-        dphi, dx, dy, dthl, dthr = self.f(x, u)
-        phi, x, y, thl, thr = x
-        u1, u2 = u
-        return [phi + dphi * self.dt,
-                x   + dx   * self.dt,
-                y   + dy   * self.dt,
-                thl + dthl * self.dt,
-                thr + dthr * self.dt]
-
-    def h(self, x, y_obs):
-        return self.C @ x
-
-    def approx_A(self, x, u):
-        """
-        dg/dx evaluated at (x, u)
-        g = x + f(x, u) * dt
-        dg/dx = I + df/dx * dt
-        """
-        phi, x, y, thl, thr = x
-        u1, u2 = u
-        df_dx = np.zeros((5, 5))
-        df_dx[1, 0] = -(u1 + u2) * (self.r / 2) * np.sin(phi)
-        df_dx[2, 0] = +(u1 + u2) * (self.r / 2) * np.cos(phi)
-        dg_dx = np.eye(5) + df_dx * self.dt
-        return dg_dx
-    
-    def approx_C(self, x):
-        """
-        dh/dx evaluated at (x)
-        h = Cx
-        dh/dx = C
-        """
-        return self.C
+        # Counters first, see grow. Wait for the first state, input and
+        # output; an empty buffer row is uninitialized
+        n_x_hat, n_x = self._n_x_hat, self._n_x
+        n_u, n_y = self._n_u, self._n_y
+        if (n_x_hat > 0 and n_x > 0 and n_u > 0 and n_y > 0 and
+                self.x_hat[n_x_hat - 1, 0] < self.x[n_x - 1, 0]):
+            x_hat_t = self.x_hat[n_x_hat - 1, 1:]
+            u_t = self.u[n_u - 1, 1:]
+            y_t = self.y[n_y - 1, 1:]
+
+            x_hat_tp1, self.P = unicycle_ekf_step(
+                x_hat_t, self.P, u_t, y_t, self.Q, self.R, self._params)
+            t = self.x_hat[n_x_hat - 1, 0]
+            x_tp1 = np.concatenate(([t + self.dt], x_hat_tp1))
+            self.append_x_hat(x_tp1)
+            rospy.logdebug('x_hat: %s, x: %s, y: %s',
+                           x_tp1, self.x[n_x - 1], self.y[n_y - 1])
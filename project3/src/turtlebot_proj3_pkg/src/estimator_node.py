@@ -2,9 +2,8 @@
 import rospy
 from Estimator import \
     OracleObserver, DeadReckoning, KalmanFilter, ExtendedKalmanFilter
-import matplotlib.pyplot as plt
-from matplotlib.animation import FuncAnimation
-plt.show(block=True)
+import pyqtgraph as pg
+from pyqtgraph.Qt import QtCore
 
 
 def spin(estimator):
@@ -22,13 +21,21 @@ def spin(estimator):
     -------
         None
     """
-    # noinspection PyUnusedLocal
-    anim = FuncAnimation(
-        estimator.fig,
-        estimator.plot_update,
-        init_func=estimator.plot_init,
-        cache_frame_data=False)
-    plt.show(block=True)  # This functions the same as rospy.spin()
+    def tick():
+        # ROS callbacks only write rows into the estimator's buffers, and
+        # plot_update reads each counter before its buffer; all Qt calls
+        # stay on this (main) thread.
+        if rospy.is_shutdown():
+            estimator.app.quit()
+        else:
+            estimator.plot_update()
+
+    estimator.plot_init()
+    timer = QtCore.QTimer()
+    timer.timeout.connect(tick)
+    timer.start(int(estimator.dt * 1000))
+    pg.exec()  # This functions the same as rospy.spin()
+    estimator.plot_save()
 
 
 def main():